@@ -6,73 +6,386 @@ Converts HEIC files from Google Drive to compressed JPG files for blog use.
 
 import os
 import io
+import sqlite3
+import asyncio
+import tempfile
+import threading
+import time
+import random
+import multiprocessing
+import signal
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 from pathlib import Path
-from typing import List, Optional, Tuple
+from typing import BinaryIO, Iterator, List, Optional, Tuple, Union
 import argparse
 import logging
+from functools import cached_property, partial, wraps
 from dotenv import load_dotenv
 
+import httplib2
+import google_auth_httplib2
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseDownload
+from googleapiclient.errors import HttpError
+from googleapiclient.http import HttpRequest, MediaIoBaseDownload
 
-from PIL import Image
+from PIL import Image, ImageStat, features
 import pillow_heif
 
 # Load environment variables
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 # Enable HEIF support in Pillow
 pillow_heif.register_heif_opener()
 
 # Google Drive API scope
 SCOPES = ['https://www.googleapis.com/auth/drive.readonly']
 
+# Socket timeout in seconds for Drive HTTP connections
+HTTP_TIMEOUT = 30
+
+# Maximum number of calls Drive accepts in one batch request
+BATCH_SIZE = 100
+
+# Downloads larger than this are spooled to disk instead of memory
+SPOOL_MAX_SIZE = 8 * 1024 * 1024
+
+# Ledger of converted Drive file IDs, kept in the output directory so an
+# interrupted run resumes without downloading finished files again
+LEDGER_FILE = '.heic2jpg.db'
+
+# Images at most this factor over max_size are kept as is, since a full
+# LANCZOS pass to shave off a few pixels costs more than it gains
+RESIZE_TOLERANCE = 1.02
+
+# Resizes first box-reduce by the whole-number part of (scale / gap). A gap
+# of 3.0 leaves LANCZOS at least a 3x step, which Pillow documents as
+# indistinguishable from a full LANCZOS resize; smaller gaps trade quality
+RESIZE_REDUCING_GAP = 3.0
+
+# Dynamic quality: flat images (low luminance variance) hide compression
+# artifacts and are saved below the requested quality, detailed ones above it
+LOW_DETAIL_VARIANCE = 200
+HIGH_DETAIL_VARIANCE = 2000
+LOW_DETAIL_QUALITY_OFFSET = -7
+HIGH_DETAIL_QUALITY_OFFSET = 3
+MAX_DYNAMIC_QUALITY = 95
+
+# Listed files waiting for a worker; bounds how far listing runs ahead
+LIST_QUEUE_SIZE = 200
+
+# Per-thread JPG encode buffer, kept at the size of the largest JPG so far
+# so later encodes write into it without regrowing it
+_encode_buffers = threading.local()
+
 class Config:
-    """Configuration class for loading settings from environment variables"""
+    """Configuration class for loading settings from environment variables
+    
+    Each setting is read from the environment once per instance and cached.
+    """
     
     @staticmethod
     def get_str(key: str, default: str = '') -> str:
-        return os.getenv(key, default)
+        return os.environ.get(key, default)
     
     @staticmethod
     def get_int(key: str, default: int = 0) -> int:
-        try:
-            return int(os.getenv(key, str(default)))
-        except ValueError:
+        value = os.environ.get(key)
+        if value is None:
             return default
+        
+        # Validate up front instead of catching ValueError from int()
+        value = value.strip()
+        digits = value[1:] if value[:1] in ('+', '-') else value
+        return int(value) if digits.isdecimal() else default
     
-    @property
+    @cached_property
     def credentials_file(self) -> str:
         return self.get_str('GOOGLE_CREDENTIALS_FILE', 'credentials.json')
     
-    @property
+    @cached_property
     def token_file(self) -> str:
         return self.get_str('GOOGLE_TOKEN_FILE', 'token.json')
     
-    @property
+    @cached_property
     def default_quality(self) -> int:
         return self.get_int('DEFAULT_QUALITY', 85)
     
-    @property
+    @cached_property
     def default_max_width(self) -> int:
         return self.get_int('DEFAULT_MAX_WIDTH', 1920)
     
-    @property
+    @cached_property
     def default_max_height(self) -> int:
         return self.get_int('DEFAULT_MAX_HEIGHT', 1080)
     
-    @property
+    @cached_property
     def default_output_dir(self) -> str:
         return self.get_str('DEFAULT_OUTPUT_DIR', 'converted')
+    
+    @cached_property
+    def default_max_concurrent(self) -> int:
+        return self.get_int('DEFAULT_MAX_CONCURRENT', 4)
+    
+    @cached_property
+    def default_processes(self) -> int:
+        # The CPUs this process may run on; os.cpu_count() reports every host
+        # core even inside a container limited to a few
+        if hasattr(os, 'sched_getaffinity'):
+            cpus = len(os.sched_getaffinity(0))
+        else:
+            cpus = os.cpu_count() or 1
+        return self.get_int('DEFAULT_PROCESSES', cpus)
+    
+    @cached_property
+    def drive_requests_per_second(self) -> int:
+        return self.get_int('DRIVE_REQUESTS_PER_SECOND', 10)
+    
+    @cached_property
+    def drive_num_retries(self) -> int:
+        return self.get_int('DRIVE_NUM_RETRIES', 5)
+
+class RateLimiter:
+    """Thread-safe token bucket allowing `rate` calls per second
+    
+    Bursts of up to `rate` calls pass immediately; a rate of 0 disables limiting.
+    """
+    
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.capacity = max(rate, 1)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def acquire(self) -> None:
+        """Block until a call is allowed"""
+        if self.rate <= 0:
+            return
+        
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            # Going negative reserves a slot, so waiting callers are served in order
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        
+        if wait:
+            time.sleep(wait)
+
+class Ledger:
+    """SQLite record of the Drive files already converted into an output directory
+    
+    Each add() commits (and syncs) on its own, so it is called from pool
+    threads; the lock keeps them to one statement at a time.
+    """
+    
+    def __init__(self, path: Union[str, Path]):
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS processed (file_id TEXT PRIMARY KEY, output TEXT)'
+        )
+    
+    def processed_ids(self) -> set:
+        with self._lock:
+            return {row[0] for row in self.connection.execute('SELECT file_id FROM processed')}
+    
+    def add(self, file_id: str, output: str) -> None:
+        with self._lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO processed (file_id, output) VALUES (?, ?)', (file_id, output)
+            )
+    
+    def close(self) -> None:
+        with self._lock:
+            self.connection.close()
+
+def choose_quality(image: Image.Image, quality: int) -> int:
+    """Adjust JPG quality to the amount of detail in the image"""
+    variance = ImageStat.Stat(image.convert('L')).var[0]
+    if variance < LOW_DETAIL_VARIANCE:
+        return max(quality + LOW_DETAIL_QUALITY_OFFSET, 1)
+    if variance > HIGH_DETAIL_VARIANCE:
+        return min(quality + HIGH_DETAIL_QUALITY_OFFSET, max(quality, MAX_DYNAMIC_QUALITY))
+    return quality
+
+def init_worker() -> None:
+    """Set up a conversion process when the pool starts it
+    
+    Runs after the process has imported this module (and with it Pillow and
+    pillow-heif). Ctrl-C is left to the main process, which shuts the pool down.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def run_in_daemon_thread(func, *args) -> asyncio.Future:
+    """Call func(*args) on a daemon thread and return a future of the running loop
+    
+    Unlike executor threads the thread is never joined, so a cancelled run
+    does not wait for a blocking call such as input() to return first.
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    
+    def resolve(result, exception) -> None:
+        if future.done():
+            return
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+    
+    def run() -> None:
+        try:
+            result, exception = func(*args), None
+        except Exception as e:
+            result, exception = None, e
+        try:
+            loop.call_soon_threadsafe(resolve, result, exception)
+        except RuntimeError:
+            # The loop was closed while func was running
+            pass
+    
+    threading.Thread(target=run, daemon=True).start()
+    return future
+
+def convert_heic_to_jpg(heic_data: Union[bytes, BinaryIO], quality: int = 85, max_size: Tuple[int, int] = (1920, 1080),
+                        output: Optional[Union[str, Path, BinaryIO]] = None,
+                        dynamic_quality: bool = False) -> Optional[bytes]:
+    """Convert HEIC data (bytes or a readable file object) to compressed JPG
+    
+    If output (a path or writable file object) is given the JPG is written
+    there directly and None is returned, otherwise the JPG is returned as
+    bytes. With dynamic_quality the quality is adjusted per image by
+    choose_quality(). Module-level so it can be sent to worker processes.
+    """
+    try:
+        # Load HEIC image
+        if isinstance(heic_data, bytes):
+            heic_data = io.BytesIO(heic_data)
+        if pillow_heif.is_supported(heic_data):
+            # Decode with libheif directly, skipping Image.open's format probing.
+            # pillow-heif hands libheif a bytes object, reading file objects with
+            # one read() (a mmap would be copied by bytes() the same way).
+            heif_file = pillow_heif.read_heif(heic_data)
+            image = Image.frombytes(
+                heif_file.mode, heif_file.size, heif_file.data, 'raw', heif_file.mode, heif_file.stride
+            )
+        else:
+            image = Image.open(heic_data)
+        
+        # JPEG sources decode straight to RGB at the smallest 1/2, 1/4 or 1/8
+        # DCT scale that still covers max_size
+        if image.format == 'JPEG':
+            image.draft('RGB', max_size)
+        
+        # Palette and bilevel images can only be resized with NEAREST, and 16-bit
+        # grayscale (e.g. PNG) cannot be resized at all, so convert them up
+        # front; other modes are converted after resizing
+        if image.mode == 'P':
+            image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+        elif image.mode == '1' or image.mode.startswith('I;16'):
+            image = image.convert('L')
+        
+        # Resize if image is larger than max_size beyond the tolerance.
+        # pillow-heif has no scale-on-decode, so HEIC decodes at full size.
+        if (image.size[0] > max_size[0] * RESIZE_TOLERANCE
+                or image.size[1] > max_size[1] * RESIZE_TOLERANCE):
+            # One resize() call does the box reduce and the final LANCZOS step,
+            # reading each source pixel once
+            ratio = min(max_size[0] / image.size[0], max_size[1] / image.size[1])
+            new_size = (max(round(image.size[0] * ratio), 1), max(round(image.size[1] * ratio), 1))
+            image = image.resize(new_size, Image.Resampling.LANCZOS, reducing_gap=RESIZE_REDUCING_GAP)
+            logger.info(f"Resized image to {image.size}")
+        
+        # Convert to RGB if necessary, after resizing so it touches fewer pixels.
+        # Grayscale is saved as a single-channel JPG, and transparent images
+        # are flattened onto white rather than showing the colour under alpha.
+        if image.mode in ('RGBA', 'LA'):
+            background = Image.new('RGB', image.size, (255, 255, 255))
+            # An image with alpha is its own mask, so the blend runs in one C
+            # pass over the pixels without first copying out the alpha band
+            background.paste(image, mask=image)
+            image = background
+        elif image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        
+        if dynamic_quality:
+            quality = choose_quality(image, quality)
+        
+        # Save as progressive JPG, typically a few percent smaller at the same quality,
+        # with 4:2:0 chroma subsampling pinned regardless of Pillow's default.
+        # Progressive/optimized encodes are buffered whole by Pillow and reach
+        # the output in a single write(), so no extra write buffering is needed.
+        if output is not None:
+            image.save(output, format='JPEG', quality=quality, optimize=True, progressive=True, subsampling=2)
+            return None
+        
+        buffer = getattr(_encode_buffers, 'buffer', None)
+        if buffer is None:
+            buffer = _encode_buffers.buffer = io.BytesIO()
+        buffer.seek(0)
+        image.save(buffer, format='JPEG', quality=quality, optimize=True, progressive=True, subsampling=2)
+        # Not truncated, which would shrink it; anything past tell() is stale
+        with buffer.getbuffer() as view:
+            return bytes(view[:buffer.tell()])
+        
+    except Exception as e:
+        logger.error(f"Error converting HEIC to JPG: {e}")
+        raise
+
+
+def is_retryable(exception: Exception) -> bool:
+    """Whether a failed Drive call is worth retrying (rate limited or server error)"""
+    return isinstance(exception, HttpError) and (exception.resp.status == 429 or exception.resp.status >= 500)
+
+def retry_after(exception: HttpError) -> float:
+    """Seconds a refused Drive call asks to wait before retrying, from Retry-After"""
+    value = exception.resp.get('retry-after')
+    if not isinstance(value, str):
+        return 0
+    value = value.strip()
+    if value.isdecimal():
+        return float(value)
+    try:
+        # The header may also be an HTTP date
+        return max((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0)
+    except (TypeError, ValueError):
+        return 0
+
+def requires_service(method):
+    """Raise unless authenticated, checked on the first call only
+    
+    Once the service exists the undecorated method is bound onto the instance,
+    so the per-file Drive calls of a batch skip the check.
+    """
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if not self.service:
+            raise RuntimeError("Not authenticated. Call authenticate() first.")
+        bound = method.__get__(self)
+        setattr(self, method.__name__, bound)
+        return bound(*args, **kwargs)
+    return wrapper
+
 
 class HeicToJpgConverter:
-    def __init__(self, credentials_file: str = 'credentials.json', token_file: str = 'token.json'):
+    def __init__(self, credentials_file: str = 'credentials.json', token_file: str = 'token.json',
+                 requests_per_second: float = 10, num_retries: int = 5):
         self.credentials_file = credentials_file
         self.token_file = token_file
         self.service = None
+        # Drive calls are throttled to stay under quota, and 429/5xx responses
+        # are retried by googleapiclient with randomized exponential backoff
+        self.rate_limiter = RateLimiter(requests_per_second)
+        self.num_retries = num_retries
         self.logger = self._setup_logger()
         
     def _setup_logger(self) -> logging.Logger:
@@ -82,6 +395,17 @@ class HeicToJpgConverter:
         )
         return logging.getLogger(__name__)
     
+    @property
+    def service(self):
+        return self._service
+    
+    @service.setter
+    def service(self, service) -> None:
+        # Each service.files() call builds a new Resource from the discovery
+        # document, so the one used for every Drive call is built once here
+        self._service = service
+        self.files = service.files() if service else None
+    
     def authenticate(self) -> None:
         """Authenticate with Google Drive API"""
         creds = None
@@ -107,139 +431,339 @@ class HeicToJpgConverter:
             with open(self.token_file, 'w') as token:
                 token.write(creds.to_json())
         
-        self.service = build('drive', 'v3', credentials=creds)
+        # httplib2.Http is not thread-safe, so each worker thread gets its own
+        # authorized transport and keeps reusing its keep-alive connection
+        local = threading.local()
+        
+        def build_request(http, *args, **kwargs):
+            if not hasattr(local, 'http'):
+                local.http = google_auth_httplib2.AuthorizedHttp(
+                    creds, http=httplib2.Http(timeout=HTTP_TIMEOUT)
+                )
+            return HttpRequest(local.http, *args, **kwargs)
+        
+        # Use the discovery document bundled with googleapiclient instead of
+        # fetching it from Google on every run
+        self.service = build(
+            'drive', 'v3', credentials=creds, requestBuilder=build_request,
+            cache_discovery=False, static_discovery=True
+        )
         self.logger.info("Successfully authenticated with Google Drive")
     
-    def list_heic_files(self, folder_id: Optional[str] = None) -> List[dict]:
+    def list_heic_files(self, folder_id: Optional[str] = None, include_by_name: bool = False) -> List[dict]:
         """List all HEIC files in Google Drive or specific folder"""
-        if not self.service:
-            raise RuntimeError("Not authenticated. Call authenticate() first.")
+        files = []
+        for page in self._iter_heic_pages(folder_id, include_by_name):
+            files.extend(page)
+        
+        self.logger.info(f"Found {len(files)} HEIC files")
+        return files
+    
+    @requires_service
+    def _iter_heic_pages(self, folder_id: Optional[str] = None,
+                         include_by_name: bool = False) -> Iterator[List[dict]]:
+        """Yield HEIC files one result page at a time, following nextPageToken
         
-        query = "mimeType='image/heic' or name contains '.heic' or name contains '.HEIC'"
+        Files are matched by MIME type, which Drive answers from its index.
+        include_by_name adds a filename search for HEIC files uploaded with
+        the wrong MIME type, at the cost of a slower query.
+        """
+        query = "mimeType='image/heic' or mimeType='image/heif'"
+        if include_by_name:
+            query += " or name contains '.heic' or name contains '.HEIC'"
         if folder_id:
             query = f"'{folder_id}' in parents and ({query})"
         
-        results = self.service.files().list(
+        request = self.files.list(
             q=query,
             pageSize=1000,
             fields="nextPageToken, files(id, name, size, createdTime)"
-        ).execute()
-        
-        files = results.get('files', [])
-        self.logger.info(f"Found {len(files)} HEIC files")
-        return files
+        )
+        while request is not None:
+            self.rate_limiter.acquire()
+            results = request.execute(num_retries=self.num_retries)
+            
+            yield results.get('files', [])
+            
+            # None once there is no nextPageToken
+            request = self.files.list_next(request, results)
     
-    def download_file(self, file_id: str, file_name: str) -> bytes:
-        """Download file from Google Drive"""
-        if not self.service:
-            raise RuntimeError("Not authenticated. Call authenticate() first.")
+    @requires_service
+    def download_file(self, file_id: str, file_name: str, fh: Optional[BinaryIO] = None) -> Optional[BinaryIO]:
+        """Download file from Google Drive
         
-        request = self.service.files().get_media(fileId=file_id)
-        file_io = io.BytesIO()
-        downloader = MediaIoBaseDownload(file_io, request)
-        
-        done = False
-        while done is False:
-            status, done = downloader.next_chunk()
-            if status:
-                self.logger.info(f"Downloading {file_name}: {int(status.progress() * 100)}%")
-        
-        return file_io.getvalue()
-    
-    def convert_heic_to_jpg(self, heic_data: bytes, quality: int = 85, max_size: Tuple[int, int] = (1920, 1080)) -> bytes:
-        """Convert HEIC data to compressed JPG"""
+        If a writable file object is given the content is streamed into it and
+        None is returned. Otherwise the content is streamed into a new
+        SpooledTemporaryFile, which is returned rewound; the caller closes it.
+        """
+        request = self.files.get_media(fileId=file_id)
+        file_io = fh if fh is not None else tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
         try:
-            # Load HEIC image
-            image = Image.open(io.BytesIO(heic_data))
-            
-            # Convert to RGB if necessary
-            if image.mode != 'RGB':
-                image = image.convert('RGB')
+            # The default chunk size (100 MiB) fetches a whole photo per request
+            downloader = MediaIoBaseDownload(file_io, request)
             
-            # Resize if image is larger than max_size
-            if image.size[0] > max_size[0] or image.size[1] > max_size[1]:
-                image.thumbnail(max_size, Image.Resampling.LANCZOS)
-                self.logger.info(f"Resized image to {image.size}")
-            
-            # Save as JPG
-            output = io.BytesIO()
-            image.save(output, format='JPEG', quality=quality, optimize=True)
-            
-            return output.getvalue()
-            
-        except Exception as e:
-            self.logger.error(f"Error converting HEIC to JPG: {e}")
+            done = False
+            while done is False:
+                self.rate_limiter.acquire()
+                status, done = downloader.next_chunk(num_retries=self.num_retries)
+                if status:
+                    self.logger.info(f"Downloading {file_name}: {int(status.progress() * 100)}%")
+        except Exception:
+            if fh is None:
+                file_io.close()
             raise
+        
+        if fh is None:
+            file_io.seek(0)
+            return file_io
+        return None
     
+    def convert_heic_to_jpg(self, heic_data: Union[bytes, BinaryIO], quality: int = 85, max_size: Tuple[int, int] = (1920, 1080),
+                            output: Optional[Union[str, Path, BinaryIO]] = None,
+                            dynamic_quality: bool = False) -> Optional[bytes]:
+        """Convert HEIC data to compressed JPG, writing to output if given"""
+        return convert_heic_to_jpg(heic_data, quality, max_size, output, dynamic_quality)
+    
+    @requires_service
     def delete_drive_file(self, file_id: str, file_name: str) -> bool:
         """Delete file from Google Drive"""
-        if not self.service:
-            raise RuntimeError("Not authenticated. Call authenticate() first.")
-        
         try:
-            self.service.files().delete(fileId=file_id).execute()
+            self.rate_limiter.acquire()
+            self.files.delete(fileId=file_id).execute(num_retries=self.num_retries)
             self.logger.info(f"Deleted original HEIC file: {file_name}")
             return True
         except Exception as e:
             self.logger.error(f"Error deleting file {file_name}: {e}")
             return False
     
+    @requires_service
+    def delete_drive_files(self, files: List[Tuple[str, str]]) -> int:
+        """Delete files from Google Drive in batch requests, returning the number deleted
+        
+        Drive counts every call in a batch against the quota, so each takes its
+        own rate-limit token. Batches are not retried by googleapiclient, so
+        calls refused with 429/5xx are sent again in a later batch with the
+        same randomized exponential backoff, up to num_retries times, waiting
+        at least as long as any Retry-After header asks.
+        """
+        file_names = dict(files)
+        deleted_count = 0
+        pending = [file_id for file_id, _ in files]
+        retry_ids = []
+        retry_wait = 0
+        
+        def on_delete(request_id, response, exception):
+            nonlocal deleted_count, retry_wait
+            file_name = file_names[request_id]
+            if exception is None:
+                self.logger.info(f"Deleted original HEIC file: {file_name}")
+                deleted_count += 1
+            elif is_retryable(exception) and attempt < self.num_retries:
+                retry_ids.append(request_id)
+                retry_wait = max(retry_wait, retry_after(exception))
+            else:
+                self.logger.error(f"Error deleting file {file_name}: {exception}")
+        
+        for attempt in range(self.num_retries + 1):
+            if attempt:
+                time.sleep(max(random.random() * 2 ** attempt, retry_wait))
+                retry_wait = 0
+            
+            for start in range(0, len(pending), BATCH_SIZE):
+                batch = self.service.new_batch_http_request(callback=on_delete)
+                for file_id in pending[start:start + BATCH_SIZE]:
+                    self.rate_limiter.acquire()
+                    batch.add(self.files.delete(fileId=file_id), request_id=file_id)
+                
+                try:
+                    batch.execute()
+                except Exception as e:
+                    self.logger.error(f"Error executing delete batch: {e}")
+            
+            if not retry_ids:
+                break
+            pending, retry_ids = retry_ids, []
+        
+        return deleted_count
+    
     def confirm_deletion(self, file_count: int) -> bool:
         """Ask user confirmation for deleting original HEIC files"""
         if file_count == 0:
             return False
         
         print(f"\n{file_count} HEIC files have been successfully converted to JPG.")
-        response = input("Do you want to delete the original HEIC files from Google Drive? (y/N): ").strip().lower()
+        try:
+            response = input("Do you want to delete the original HEIC files from Google Drive? (y/N): ").strip().lower()
+        except (EOFError, OSError):
+            # No interactive stdin (cron, pipes): keep the originals
+            self.logger.info("No confirmation available, keeping original HEIC files")
+            return False
         return response in ['y', 'yes']
     
     def process_files(self, output_dir: str = 'converted', quality: int = 85, 
                      max_size: Tuple[int, int] = (1920, 1080), folder_id: Optional[str] = None,
-                     auto_delete: bool = False):
-        """Process all HEIC files and convert to JPG"""
+                     auto_delete: bool = False, max_concurrent: int = 4, processes: int = 0,
+                     dynamic_quality: bool = False, include_by_name: bool = False):
+        """Process all HEIC files and convert to JPG
+        
+        Up to max_concurrent files are downloaded at once while earlier
+        downloads are converted. With processes > 0 conversions run in that
+        many worker processes, otherwise in max_concurrent threads.
+        max_concurrent only bounds the downloads, not the conversions.
+        """
+        if max_concurrent < 1:
+            raise ValueError(f"max_concurrent must be at least 1, got {max_concurrent}")
+        if processes < 0:
+            raise ValueError(f"processes must not be negative, got {processes}")
+        
         if not self.service:
             self.authenticate()
         
         # Create output directory
         Path(output_dir).mkdir(exist_ok=True)
         
-        # Get list of HEIC files
-        heic_files = self.list_heic_files(folder_id)
-        
-        if not heic_files:
-            self.logger.info("No HEIC files found")
-            return
+        asyncio.run(self._process_files_async(
+            output_dir, quality, max_size, folder_id, auto_delete, max_concurrent, processes,
+            dynamic_quality, include_by_name
+        ))
+    
+    async def _process_files_async(self, output_dir: str, quality: int, max_size: Tuple[int, int],
+                                   folder_id: Optional[str], auto_delete: bool, max_concurrent: int,
+                                   processes: int = 0, dynamic_quality: bool = False,
+                                   include_by_name: bool = False) -> List[Tuple[str, str]]:
+        """List, download, convert and delete files concurrently
         
-        processed_count = 0
+        Returns the (file_id, file_name) of the files converted. With auto_delete
+        originals are deleted in batches while conversion is still running.
+        """
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=LIST_QUEUE_SIZE)
+        # Output names already on disk or claimed by another file in this run,
+        # read with one directory scan instead of a stat() per file. scandir
+        # yields plain names, skipping the Path objects and pattern matching of glob.
+        # Names are casefolded: on macOS and Windows IMG_1.JPG is the same file
+        # as IMG_1.jpg, and converting over it would replace the user's file.
+        with os.scandir(output_dir) as entries:
+            existing = {name for name in (entry.name.casefold() for entry in entries) if name.endswith('.jpg')}
+        # The ledger is opened once listing finds a file, so runs that find
+        # nothing leave no database behind
+        ledger = None
+        converted_ids = set()
         processed_files = []
+        pending_deletes = []
+        found_count = 0
+        deleted_count = 0
+        
+        async def delete_pending() -> None:
+            nonlocal deleted_count
+            files = pending_deletes[:]
+            pending_deletes.clear()
+            deleted_count += await loop.run_in_executor(executor, self.delete_drive_files, files)
         
-        for file_info in heic_files:
+        async def produce() -> None:
+            # Fetch the next page while workers convert the current one
+            nonlocal found_count, ledger
+            pages = self._iter_heic_pages(folder_id, include_by_name)
             try:
-                file_name = file_info['name']
-                file_id = file_info['id']
-                
-                # Skip if already converted
-                jpg_name = Path(file_name).stem + '.jpg'
-                output_path = Path(output_dir) / jpg_name
-                
-                if output_path.exists():
-                    self.logger.info(f"Skipping {file_name} (already exists)")
-                    continue
-                
-                self.logger.info(f"Processing {file_name}...")
-                
-                # Download file
-                heic_data = self.download_file(file_id, file_name)
-                
-                # Convert to JPG
-                jpg_data = self.convert_heic_to_jpg(heic_data, quality, max_size)
+                while True:
+                    page = await loop.run_in_executor(executor, next, pages, None)
+                    if page is None:
+                        break
+                    if page and ledger is None:
+                        ledger = Ledger(os.path.join(output_dir, LEDGER_FILE))
+                        converted_ids.update(ledger.processed_ids())
+                    found_count += len(page)
+                    for file_info in page:
+                        await queue.put(file_info)
+            finally:
+                for _ in range(max_concurrent):
+                    await queue.put(None)
+        
+        async def fetch() -> None:
+            while True:
+                file_info = await queue.get()
+                if file_info is None:
+                    return
+                download = await download_one(file_info)
+                if download:
+                    await downloads.put(download)
+        
+        async def fetch_all() -> None:
+            try:
+                await asyncio.gather(*[fetch() for _ in range(max_concurrent)])
+            finally:
+                for _ in range(converters):
+                    await downloads.put(None)
+        
+        async def work() -> None:
+            while True:
+                download = await downloads.get()
+                if download is None:
+                    return
+                result = await convert_one(*download)
+                if result:
+                    processed_files.append(result)
+                    pending_deletes.append(result)
+                    if auto_delete and len(pending_deletes) >= BATCH_SIZE:
+                        await delete_pending()
+        
+        async def download_one(file_info: dict) -> Optional[Tuple[dict, str, BinaryIO, int]]:
+            file_name = file_info['name']
+            file_id = file_info['id']
+            
+            # Skip if already converted or another file in this run maps to the same name.
+            # Per-file paths are plain strings, avoiding a Path object per operation.
+            jpg_name = os.path.splitext(os.path.basename(file_name))[0] + '.jpg'
+            if file_id in converted_ids:
+                self.logger.info(f"Skipping {file_name} (already converted)")
+                return None
+            if jpg_name.casefold() in existing:
+                self.logger.info(f"Skipping {file_name} (already exists)")
+                return None
+            existing.add(jpg_name.casefold())
+            if processes > 0 and process_pool is None:
+                start_process_pool()
+            
+            self.logger.info(f"Processing {file_name}...")
+            heic_file = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+            try:
+                await loop.run_in_executor(executor, self.download_file, file_id, file_name, heic_file)
+            except Exception as e:
+                self.logger.error(f"Error processing {file_name}: {e}")
+                heic_file.close()
+                return None
+            original_size = heic_file.tell()
+            heic_file.seek(0)
+            return file_info, jpg_name, heic_file, original_size
+        
+        async def convert_one(file_info: dict, jpg_name: str, heic_file: BinaryIO,
+                              original_size: int) -> Optional[Tuple[str, str]]:
+            file_name = file_info['name']
+            file_id = file_info['id']
+            output_path = os.path.join(output_dir, jpg_name)
+            partial_path = output_path + '.part'
+            
+            try:
+                with heic_file:
+                    # Convert to JPG, letting Pillow write the file itself. It goes
+                    # to a temporary name first so an interrupted write never
+                    # leaves a truncated .jpg that later runs would skip.
+                    if process_pool:
+                        # Read on a thread: downloads over SPOOL_MAX_SIZE are on disk
+                        heic_data = await loop.run_in_executor(executor, heic_file.read)
+                        await loop.run_in_executor(
+                            process_pool, partial(convert, output=partial_path), heic_data
+                        )
+                    else:
+                        await loop.run_in_executor(
+                            executor, partial(convert, output=partial_path), heic_file
+                        )
                 
-                # Save JPG file
-                with open(output_path, 'wb') as f:
-                    f.write(jpg_data)
+                os.replace(partial_path, output_path)
+                # The commit waits on the disk, so it stays off the loop
+                await loop.run_in_executor(executor, ledger.add, file_id, jpg_name)
                 
-                original_size = len(heic_data)
-                compressed_size = len(jpg_data)
+                compressed_size = os.path.getsize(output_path)
                 compression_ratio = (1 - compressed_size / original_size) * 100
                 
                 self.logger.info(
@@ -248,26 +772,95 @@ class HeicToJpgConverter:
                     f"{compression_ratio:.1f}% smaller)"
                 )
                 
-                processed_count += 1
-                processed_files.append((file_id, file_name))
+                return file_id, file_name
                 
             except Exception as e:
                 self.logger.error(f"Error processing {file_name}: {e}")
-                continue
+                try:
+                    os.remove(partial_path)
+                except FileNotFoundError:
+                    pass
+                return None
         
-        self.logger.info(f"Successfully processed {processed_count} files")
+        # Downloading and converting are separate stages joined by a short
+        # queue, so downloads keep going while every converter is busy.
+        # Downloads are network-bound and Pillow releases the GIL while decoding,
+        # resizing and encoding, so one thread pool serves both stages; the
+        # extra thread keeps listing from waiting behind them. With worker
+        # processes each converter's thread only reads its download for them.
+        # Worker processes take the remaining Python-level work off the GIL;
+        # they are spawned because forking alongside I/O threads can deadlock.
+        converters = processes or max_concurrent
+        downloads = asyncio.Queue(maxsize=max_concurrent)
+        process_pool = None
+        threads = max_concurrent + 1 + converters
         
-        # Ask for deletion confirmation
-        if processed_files:
-            should_delete = auto_delete or self.confirm_deletion(len(processed_files))
-            
-            if should_delete:
-                deleted_count = 0
-                for file_id, file_name in processed_files:
-                    if self.delete_drive_file(file_id, file_name):
-                        deleted_count += 1
+        def start_process_pool() -> None:
+            # Called for the first file to download, so runs with nothing new
+            # (the usual cron case) spawn no interpreters. Every worker starts
+            # at once so spawning and imports overlap the first downloads
+            # instead of delaying the first conversions.
+            nonlocal process_pool
+            process_pool = ProcessPoolExecutor(
+                max_workers=processes, mp_context=multiprocessing.get_context('spawn'),
+                initializer=init_worker
+            )
+            for _ in range(processes):
+                process_pool.submit(int)
+        
+        # The settings are the same for every file, so the converter is bound to
+        # them once; each call only adds the file and its output path. A partial
+        # of the module-level function can still be sent to worker processes.
+        convert = partial(
+            convert_heic_to_jpg if processes > 0 else self.convert_heic_to_jpg,
+            quality=quality, max_size=max_size, dynamic_quality=dynamic_quality
+        )
+        
+        try:
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+                await asyncio.gather(produce(), fetch_all(), *[work() for _ in range(converters)])
+                
+                self.logger.info(f"Found {found_count} HEIC files")
+                if not found_count:
+                    self.logger.info("No HEIC files found")
+                    return processed_files
+                
+                self.logger.info(f"Successfully processed {len(processed_files)} files")
+                
+                # Ask for deletion confirmation off the loop, on a daemon thread:
+                # input() cannot be interrupted, and Ctrl-C must not wait for it
+                # the way leaving the thread pool waits for its threads
+                should_delete = auto_delete
+                if processed_files and not auto_delete:
+                    should_delete = await run_in_daemon_thread(
+                        self.confirm_deletion, len(processed_files)
+                    )
                 
-                self.logger.info(f"Deleted {deleted_count} original HEIC files from Google Drive")
+                if should_delete and processed_files:
+                    if pending_deletes:
+                        await delete_pending()
+                    self.logger.info(f"Deleted {deleted_count} original HEIC files from Google Drive")
+        finally:
+            if process_pool:
+                process_pool.shutdown()
+            if ledger:
+                ledger.close()
+        
+        return processed_files
+
+def positive_int(value: str) -> int:
+    """argparse type for counts that must be at least 1"""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {number}")
+    return number
+
+def non_negative_int(value: str) -> int:
+    """argparse type for counts where 0 turns the feature off"""
+    number = int(value)
+    if number < 0:
+        raise argparse.ArgumentTypeError(f"must not be negative, got {number}")
+    return number
 
 def main():
     config = Config()
@@ -278,12 +871,26 @@ def main():
     parser.add_argument('--max-width', type=int, default=config.default_max_width, help='Maximum width')
     parser.add_argument('--max-height', type=int, default=config.default_max_height, help='Maximum height')
     parser.add_argument('--folder-id', help='Google Drive folder ID to process')
+    parser.add_argument('--include-by-name', action='store_true', help='Also match files named *.heic regardless of MIME type (slower listing)')
     parser.add_argument('--credentials', default=config.credentials_file, help='Google API credentials file')
     parser.add_argument('--auto-delete', action='store_true', help='Automatically delete original HEIC files without confirmation')
+    parser.add_argument('--max-concurrent', type=positive_int, default=config.default_max_concurrent, help='Number of files downloaded in parallel (and converted, with --processes 0)')
+    parser.add_argument('--dynamic-quality', action='store_true', help='Lower quality for flat images and raise it for detailed ones')
+    parser.add_argument('--processes', type=non_negative_int, default=config.default_processes, help='Number of worker processes for conversion (0 = use threads)')
     
     args = parser.parse_args()
     
-    converter = HeicToJpgConverter(credentials_file=args.credentials, token_file=config.token_file)
+    converter = HeicToJpgConverter(
+        credentials_file=args.credentials,
+        token_file=config.token_file,
+        requests_per_second=config.drive_requests_per_second,
+        num_retries=config.drive_num_retries
+    )
+    
+    # Pillow hands JPG encoding to libjpeg in C; only a libjpeg-turbo build
+    # (as in the PyPI wheels) gets the SIMD DCT and Huffman coding
+    if not features.check_feature('libjpeg_turbo'):
+        converter.logger.warning("Pillow is not built with libjpeg-turbo, JPG encoding will be slower")
     
     try:
         converter.process_files(
@@ -291,7 +898,11 @@ def main():
             quality=args.quality,
             max_size=(args.max_width, args.max_height),
             folder_id=args.folder_id,
-            auto_delete=args.auto_delete
+            auto_delete=args.auto_delete,
+            max_concurrent=args.max_concurrent,
+            processes=args.processes,
+            dynamic_quality=args.dynamic_quality,
+            include_by_name=args.include_by_name
         )
     except Exception as e:
         print(f"Error: {e}")
@@ -55,6 +55,7 @@ def mock_google_service():
     }
     
     service.files().list().execute.return_value = list_response
+    service.files().list_next.return_value = None
     
     # Mock file download
     mock_request = Mock()
@@ -62,6 +63,57 @@ def mock_google_service():
     
     return service
 
+@pytest.fixture
+def write_mock_jpg():
+    """Side effect for a mocked convert_heic_to_jpg that writes the output file"""
+    def write(heic_data, quality, max_size, output, dynamic_quality=False):
+        Path(output).write_bytes(b'mock_jpg_data')
+    return write
+
+class FakeListRequest:
+    """A files().list() page request returning a canned response"""
+    
+    def __init__(self, pages, index=0):
+        self.pages = pages
+        self.index = index
+    
+    def execute(self, num_retries=0):
+        return self.pages[self.index]
+
+class FakeFilesResource:
+    """Plain stand-in for service.files() serving canned list pages
+    
+    Unlike Mock it records nothing but the list() arguments, which keeps
+    tests that list and process many files cheap.
+    """
+    
+    def __init__(self, pages):
+        self.pages = pages
+        self.list_calls = []
+    
+    def list(self, **kwargs):
+        self.list_calls.append(kwargs)
+        return FakeListRequest(self.pages)
+    
+    def list_next(self, previous_request, previous_response):
+        if not previous_response.get('nextPageToken'):
+            return None
+        return FakeListRequest(self.pages, previous_request.index + 1)
+
+class FakeDriveService:
+    """Authenticated Drive service whose listing returns the given pages"""
+    
+    def __init__(self, pages):
+        self.files_resource = FakeFilesResource(pages)
+    
+    def files(self):
+        return self.files_resource
+
+@pytest.fixture
+def fake_drive_service():
+    """Factory for a fake Drive service listing the given result pages"""
+    return FakeDriveService
+
 @pytest.fixture
 def mock_credentials():
     """Mock Google credentials"""
@@ -79,7 +131,11 @@ def env_vars():
         'DEFAULT_QUALITY': '90',
         'DEFAULT_MAX_WIDTH': '1600',
         'DEFAULT_MAX_HEIGHT': '900',
-        'DEFAULT_OUTPUT_DIR': 'test_output'
+        'DEFAULT_OUTPUT_DIR': 'test_output',
+        'DEFAULT_MAX_CONCURRENT': '8',
+        'DEFAULT_PROCESSES': '3',
+        'DRIVE_REQUESTS_PER_SECOND': '5',
+        'DRIVE_NUM_RETRIES': '2'
     }
     
     for key, value in env_vars.items():
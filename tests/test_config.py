@@ -17,6 +17,13 @@ class TestConfig:
         assert config.default_max_width == 1920
         assert config.default_max_height == 1080
         assert config.default_output_dir == 'converted'
+        assert config.default_max_concurrent == 4
+        if hasattr(os, 'sched_getaffinity'):
+            assert config.default_processes == len(os.sched_getaffinity(0))
+        else:
+            assert config.default_processes == (os.cpu_count() or 1)
+        assert config.drive_requests_per_second == 10
+        assert config.drive_num_retries == 5
     
     def test_environment_variables(self, env_vars):
         """Test configuration from environment variables"""
@@ -28,6 +35,20 @@ class TestConfig:
         assert config.default_max_width == 1600
         assert config.default_max_height == 900
         assert config.default_output_dir == 'test_output'
+        assert config.default_max_concurrent == 8
+        assert config.default_processes == 3
+        assert config.drive_requests_per_second == 5
+        assert config.drive_num_retries == 2
+    
+    def test_values_cached_per_instance(self, env_vars):
+        """Test that settings are read once per Config instance"""
+        config = Config()
+        assert config.default_quality == 90
+        
+        os.environ['DEFAULT_QUALITY'] = '70'
+        
+        assert config.default_quality == 90
+        assert Config().default_quality == 70
     
     def test_get_str_method(self):
         """Test get_str static method"""
@@ -57,6 +78,11 @@ class TestConfig:
         result = Config.get_int('TEST_INVALID_INT', 789)
         assert result == 789
         
+        # Test signed, padded and empty values
+        for raw, expected in [('-12', -12), ('+7', 7), (' 42 ', 42), ('', 789), ('-', 789), ('1.5', 789)]:
+            os.environ['TEST_INVALID_INT'] = raw
+            assert Config.get_int('TEST_INVALID_INT', 789) == expected
+        
         if 'TEST_INT' in os.environ:
             del os.environ['TEST_INT']
         if 'TEST_INVALID_INT' in os.environ:
@@ -4,13 +4,20 @@ Tests for HeicToJpgConverter class
 
 import os
 import tempfile
+import signal
+import threading
+import time
+from email.utils import formatdate
 import pytest
 from unittest.mock import Mock, patch, MagicMock
 from pathlib import Path
 from PIL import Image
 import io
 
-from heic2jpg import HeicToJpgConverter
+import httplib2
+from googleapiclient.errors import HttpError
+
+from heic2jpg import HeicToJpgConverter, RateLimiter, init_worker, main, retry_after
 
 class TestHeicToJpgConverter:
     
@@ -56,6 +63,36 @@ class TestHeicToJpgConverter:
             converter.token_file, ['https://www.googleapis.com/auth/drive.readonly']
         )
     
+    @patch('heic2jpg.build')
+    @patch('heic2jpg.Credentials')
+    def test_authenticate_reuses_http_per_thread(self, mock_credentials, mock_build):
+        """Test requests on one thread share a transport and other threads get their own"""
+        converter = HeicToJpgConverter()
+        
+        mock_creds = Mock()
+        mock_creds.valid = True
+        mock_credentials.from_authorized_user_file.return_value = mock_creds
+        
+        with patch('os.path.exists', return_value=True):
+            converter.authenticate()
+        
+        build_request = mock_build.call_args[1]['requestBuilder']
+        assert mock_build.call_args[1]['cache_discovery'] is False
+        assert mock_build.call_args[1]['static_discovery'] is True
+        
+        first = build_request(None, Mock(), 'https://example.com/a')
+        second = build_request(None, Mock(), 'https://example.com/b')
+        
+        other = []
+        thread = threading.Thread(
+            target=lambda: other.append(build_request(None, Mock(), 'https://example.com/c'))
+        )
+        thread.start()
+        thread.join()
+        
+        assert first.http is second.http
+        assert other[0].http is not first.http
+    
     @patch('heic2jpg.build')
     @patch('heic2jpg.InstalledAppFlow')
     @patch('heic2jpg.Credentials')
@@ -120,6 +157,20 @@ class TestHeicToJpgConverter:
         query = call_args[1]['q']
         assert folder_id in query
     
+    def test_list_heic_files_query(self, mock_google_service):
+        """Test files are matched by MIME type unless name matching is requested"""
+        converter = HeicToJpgConverter()
+        converter.service = mock_google_service
+        
+        converter.list_heic_files()
+        query = mock_google_service.files().list.call_args[1]['q']
+        assert query == "mimeType='image/heic' or mimeType='image/heif'"
+        
+        converter.list_heic_files(include_by_name=True)
+        query = mock_google_service.files().list.call_args[1]['q']
+        assert "mimeType='image/heic'" in query
+        assert "name contains '.heic'" in query
+    
     def test_list_heic_files_not_authenticated(self):
         """Test listing files without authentication"""
         converter = HeicToJpgConverter()
@@ -139,20 +190,50 @@ class TestHeicToJpgConverter:
             (Mock(progress=lambda: 0.5), False),
             (Mock(progress=lambda: 1.0), True)
         ]
-        mock_download.return_value = mock_downloader
         
         # Mock file data
         test_data = b'test_file_data'
-        with patch('io.BytesIO') as mock_bytesio:
-            mock_file_io = Mock()
-            mock_file_io.getvalue.return_value = test_data
-            mock_bytesio.return_value = mock_file_io
-            
-            result = converter.download_file('file123', 'test.heic')
         
-        assert result == test_data
+        def create_downloader(fh, request):
+            fh.write(test_data)
+            return mock_downloader
+        
+        mock_download.side_effect = create_downloader
+        
+        with converter.download_file('file123', 'test.heic') as result:
+            assert result.read() == test_data
         mock_google_service.files().get_media.assert_called_once_with(fileId='file123')
     
+    @patch('heic2jpg.MediaIoBaseDownload')
+    def test_download_file_to_file_object(self, mock_download, mock_google_service):
+        """Test file download streamed into a caller-provided file object"""
+        converter = HeicToJpgConverter()
+        converter.service = mock_google_service
+        
+        mock_downloader = Mock()
+        mock_downloader.next_chunk.return_value = (None, True)
+        mock_download.return_value = mock_downloader
+        
+        fh = io.BytesIO()
+        result = converter.download_file('file123', 'test.heic', fh)
+        
+        assert result is None
+        assert mock_download.call_args[0][0] is fh
+    
+    @patch('heic2jpg.MediaIoBaseDownload')
+    def test_download_file_retries(self, mock_download, mock_google_service):
+        """Test chunk downloads retry transient errors"""
+        converter = HeicToJpgConverter(num_retries=3)
+        converter.service = mock_google_service
+        
+        mock_downloader = Mock()
+        mock_downloader.next_chunk.return_value = (None, True)
+        mock_download.return_value = mock_downloader
+        
+        converter.download_file('file123', 'test.heic', io.BytesIO())
+        
+        mock_downloader.next_chunk.assert_called_once_with(num_retries=3)
+    
     def test_download_file_not_authenticated(self):
         """Test file download without authentication"""
         converter = HeicToJpgConverter()
@@ -160,6 +241,41 @@ class TestHeicToJpgConverter:
         with pytest.raises(RuntimeError, match="Not authenticated"):
             converter.download_file('file123', 'test.heic')
     
+    @patch('heic2jpg.MediaIoBaseDownload')
+    def test_service_check_only_on_first_call(self, mock_download, mock_google_service):
+        """Test the authentication check is dropped once it has passed"""
+        converter = HeicToJpgConverter()
+        converter.service = mock_google_service
+        
+        mock_downloader = Mock()
+        mock_downloader.next_chunk.return_value = (None, True)
+        mock_download.return_value = mock_downloader
+        
+        assert 'download_file' not in vars(converter)
+        converter.download_file('file123', 'test.heic', io.BytesIO())
+        assert 'download_file' in vars(converter)
+        converter.download_file('file456', 'test2.heic', io.BytesIO())
+        
+        assert mock_downloader.next_chunk.call_count == 2
+    
+    @patch('heic2jpg.MediaIoBaseDownload')
+    def test_files_resource_built_once(self, mock_download):
+        """Test the files() resource is reused across Drive calls"""
+        converter = HeicToJpgConverter()
+        mock_service = Mock()
+        converter.service = mock_service
+        
+        mock_downloader = Mock()
+        mock_downloader.next_chunk.return_value = (None, True)
+        mock_download.return_value = mock_downloader
+        
+        converter.download_file('file123', 'test.heic', io.BytesIO())
+        converter.download_file('file456', 'test2.heic', io.BytesIO())
+        converter.delete_drive_file('file123', 'test.heic')
+        
+        mock_service.files.assert_called_once_with()
+        assert mock_service.files.return_value.get_media.call_count == 2
+    
     def test_convert_heic_to_jpg(self, sample_image_data):
         """Test HEIC to JPG conversion"""
         converter = HeicToJpgConverter()
@@ -169,10 +285,10 @@ class TestHeicToJpgConverter:
             mock_image = Mock()
             mock_image.mode = 'RGB'
             mock_image.size = (100, 100)
-            mock_image.thumbnail = Mock()
+            mock_image.resize.return_value = mock_image
             
             # Mock save
-            def mock_save(file_obj, format=None, quality=None, optimize=None):
+            def mock_save(file_obj, format=None, quality=None, optimize=None, progressive=None, subsampling=None):
                 file_obj.write(sample_image_data)
             
             mock_image.save = mock_save
@@ -182,7 +298,8 @@ class TestHeicToJpgConverter:
         
         assert isinstance(result, bytes)
         assert len(result) > 0
-        mock_image.thumbnail.assert_called_once_with((1920, 1080), Image.Resampling.LANCZOS)
+        # Already within max_size, so it is not resized
+        mock_image.resize.assert_not_called()
     
     def test_convert_heic_to_jpg_with_resize(self, sample_image_data):
         """Test HEIC to JPG conversion with resizing"""
@@ -193,9 +310,9 @@ class TestHeicToJpgConverter:
             mock_image = Mock()
             mock_image.mode = 'RGB'
             mock_image.size = (3000, 2000)  # Larger than max_size
-            mock_image.thumbnail = Mock()
+            mock_image.resize.return_value = mock_image
             
-            def mock_save(file_obj, format=None, quality=None, optimize=None):
+            def mock_save(file_obj, format=None, quality=None, optimize=None, progressive=None, subsampling=None):
                 file_obj.write(sample_image_data)
             
             mock_image.save = mock_save
@@ -208,7 +325,7 @@ class TestHeicToJpgConverter:
             )
         
         assert isinstance(result, bytes)
-        mock_image.thumbnail.assert_called_once_with((1600, 900), Image.Resampling.LANCZOS)
+        mock_image.resize.assert_called_once_with((1350, 900), Image.Resampling.LANCZOS, reducing_gap=3.0)
     
     def test_convert_heic_to_jpg_convert_mode(self, sample_image_data):
         """Test HEIC to JPG conversion with mode conversion"""
@@ -217,15 +334,14 @@ class TestHeicToJpgConverter:
         with patch('PIL.Image.open') as mock_open:
             # Mock image with non-RGB mode
             mock_image = Mock()
-            mock_image.mode = 'RGBA'
+            mock_image.mode = 'CMYK'
             mock_image.size = (100, 100)
             
             mock_rgb_image = Mock()
             mock_rgb_image.mode = 'RGB'
             mock_rgb_image.size = (100, 100)
-            mock_rgb_image.thumbnail = Mock()
             
-            def mock_save(file_obj, format=None, quality=None, optimize=None):
+            def mock_save(file_obj, format=None, quality=None, optimize=None, progressive=None, subsampling=None):
                 file_obj.write(sample_image_data)
             
             mock_rgb_image.save = mock_save
@@ -237,6 +353,139 @@ class TestHeicToJpgConverter:
         assert isinstance(result, bytes)
         mock_image.convert.assert_called_once_with('RGB')
     
+    def _mock_batch_service(self, failing_ids=(), errors=None):
+        """Mock service whose batches report each added delete to the callback
+        
+        errors maps a file ID to the exceptions its next deletes fail with.
+        """
+        service = Mock()
+        batches = []
+        errors = errors or {}
+        
+        def new_batch(callback=None):
+            batch = Mock()
+            batch.request_ids = []
+            batch.add.side_effect = lambda request, request_id=None: batch.request_ids.append(request_id)
+            
+            def execute():
+                for request_id in batch.request_ids:
+                    if request_id in failing_ids:
+                        callback(request_id, None, Exception("Delete failed"))
+                    elif errors.get(request_id):
+                        callback(request_id, None, errors[request_id].pop(0))
+                    else:
+                        callback(request_id, {}, None)
+            
+            batch.execute.side_effect = execute
+            batches.append(batch)
+            return batch
+        
+        service.new_batch_http_request.side_effect = new_batch
+        return service, batches
+    
+    def test_delete_drive_files_batches(self):
+        """Test deletes are grouped into batches of at most 100"""
+        converter = HeicToJpgConverter(requests_per_second=0)
+        converter.service, batches = self._mock_batch_service()
+        
+        files = [(f'file{i}', f'photo{i}.heic') for i in range(150)]
+        deleted_count = converter.delete_drive_files(files)
+        
+        assert deleted_count == 150
+        assert [len(batch.request_ids) for batch in batches] == [100, 50]
+    
+    def test_delete_drive_files_partial_failure(self):
+        """Test failed deletes in a batch are not counted"""
+        converter = HeicToJpgConverter()
+        converter.service, batches = self._mock_batch_service(failing_ids={'file1'})
+        
+        deleted_count = converter.delete_drive_files([('file0', 'a.heic'), ('file1', 'b.heic')])
+        
+        assert deleted_count == 1
+    
+    def test_delete_drive_files_rate_limits_each_request(self):
+        """Test every delete in a batch takes its own rate-limit token"""
+        converter = HeicToJpgConverter()
+        converter.service, batches = self._mock_batch_service()
+        converter.rate_limiter = Mock()
+        
+        converter.delete_drive_files([(f'file{i}', f'photo{i}.heic') for i in range(150)])
+        
+        assert converter.rate_limiter.acquire.call_count == 150
+    
+    @patch('heic2jpg.time.sleep')
+    def test_delete_drive_files_retries_rate_limited(self, mock_sleep):
+        """Test deletes refused with 429/5xx are sent again in a later batch"""
+        converter = HeicToJpgConverter()
+        errors = {
+            'file1': [HttpError(httplib2.Response({'status': 429}), b'Rate limit exceeded')],
+            'file2': [HttpError(httplib2.Response({'status': 503}), b'Backend error')],
+            'file3': [HttpError(httplib2.Response({'status': 404}), b'Not found')],
+        }
+        converter.service, batches = self._mock_batch_service(errors=errors)
+        
+        deleted_count = converter.delete_drive_files(
+            [('file0', 'a.heic'), ('file1', 'b.heic'), ('file2', 'c.heic'), ('file3', 'd.heic')]
+        )
+        
+        assert deleted_count == 3
+        assert [batch.request_ids for batch in batches] == [['file0', 'file1', 'file2', 'file3'], ['file1', 'file2']]
+        mock_sleep.assert_called_once()
+    
+    @patch('heic2jpg.time.sleep')
+    def test_delete_drive_files_gives_up_after_num_retries(self, mock_sleep):
+        """Test a delete that keeps being rate limited is retried num_retries times"""
+        converter = HeicToJpgConverter(num_retries=2)
+        errors = {'file1': [HttpError(httplib2.Response({'status': 429}), b'Rate limit exceeded') for _ in range(5)]}
+        converter.service, batches = self._mock_batch_service(errors=errors)
+        
+        deleted_count = converter.delete_drive_files([('file1', 'a.heic')])
+        
+        assert deleted_count == 0
+        assert len(batches) == 3
+    
+    @patch('heic2jpg.time.sleep')
+    def test_delete_drive_files_waits_for_retry_after(self, mock_sleep):
+        """Test a Retry-After header sets the minimum wait before the retry batch"""
+        converter = HeicToJpgConverter()
+        errors = {'file1': [HttpError(httplib2.Response({'status': 429, 'retry-after': '30'}), b'Rate limit exceeded')]}
+        converter.service, batches = self._mock_batch_service(errors=errors)
+        
+        deleted_count = converter.delete_drive_files([('file0', 'a.heic'), ('file1', 'b.heic')])
+        
+        assert deleted_count == 2
+        mock_sleep.assert_called_once_with(30)
+    
+    def test_retry_after_http_date(self):
+        """Test Retry-After given as an HTTP date is turned into seconds from now"""
+        later = formatdate(time.time() + 60, usegmt=True)
+        earlier = formatdate(time.time() - 60, usegmt=True)
+        
+        assert 55 <= retry_after(HttpError(httplib2.Response({'status': 503, 'retry-after': later}), b'')) <= 60
+        assert retry_after(HttpError(httplib2.Response({'status': 503, 'retry-after': earlier}), b'')) == 0
+        assert retry_after(HttpError(httplib2.Response({'status': 503}), b'')) == 0
+    
+    def test_delete_drive_files_not_authenticated(self):
+        """Test batch delete without authentication"""
+        converter = HeicToJpgConverter()
+        
+        with pytest.raises(RuntimeError, match="Not authenticated"):
+            converter.delete_drive_files([('file1', 'a.heic')])
+    
+    def test_confirm_deletion_without_stdin(self):
+        """Test deletion is declined when stdin is not available"""
+        converter = HeicToJpgConverter()
+        
+        with patch('builtins.input', side_effect=EOFError):
+            assert converter.confirm_deletion(3) is False
+    
+    def test_confirm_deletion_yes(self):
+        """Test deletion is confirmed with 'y'"""
+        converter = HeicToJpgConverter()
+        
+        with patch('builtins.input', return_value=' Y '):
+            assert converter.confirm_deletion(3) is True
+    
     @patch('pathlib.Path.mkdir')
     @patch('pathlib.Path.exists')
     def test_process_files(self, mock_exists, mock_mkdir, temp_dir, sample_image_data, mock_google_service):
@@ -248,18 +497,101 @@ class TestHeicToJpgConverter:
         mock_exists.return_value = False
         
         with patch.object(converter, 'download_file') as mock_download:
-            mock_download.return_value = b'mock_heic_data'
+            mock_download.side_effect = lambda file_id, file_name, fh: fh.write(b'mock_heic_data')
             
             with patch.object(converter, 'convert_heic_to_jpg') as mock_convert:
-                mock_convert.return_value = sample_image_data
+                # Conversion writes the JPG straight to the path it is given
+                mock_convert.side_effect = lambda heic_data, quality, max_size, output, dynamic_quality: Path(output).write_bytes(sample_image_data)
                 
-                with patch('builtins.open', create=True) as mock_open:
-                    mock_file = Mock()
-                    mock_open.return_value.__enter__.return_value = mock_file
-                    
-                    converter.process_files(output_dir=temp_dir)
+                converter.process_files(output_dir=temp_dir)
         
         # Verify calls
         assert mock_download.call_count == 2  # Two files in mock service
         assert mock_convert.call_count == 2
-        assert mock_file.write.call_count == 2
\ No newline at end of file
+        assert (Path(temp_dir) / 'photo1.jpg').read_bytes() == sample_image_data
+        assert (Path(temp_dir) / 'photo2.jpg').read_bytes() == sample_image_data
+    
+    @pytest.mark.parametrize('kwargs', [{'max_concurrent': 0}, {'max_concurrent': -1}, {'processes': -1}])
+    def test_process_files_rejects_invalid_concurrency(self, kwargs, temp_dir, mock_google_service):
+        """Test concurrency settings that would stall or crash the pipeline are rejected"""
+        converter = HeicToJpgConverter()
+        converter.service = mock_google_service
+        
+        with patch.object(converter, '_process_files_async') as mock_run:
+            with pytest.raises(ValueError):
+                converter.process_files(output_dir=temp_dir, **kwargs)
+        
+        mock_run.assert_not_called()
+
+
+class TestMain:
+    
+    @pytest.mark.parametrize('argv', [['--max-concurrent', '0'], ['--processes', '-1']])
+    def test_rejects_invalid_concurrency(self, argv, capsys):
+        """Test invalid concurrency options fail at argument parsing"""
+        with patch('sys.argv', ['heic2jpg.py', *argv]):
+            with patch('heic2jpg.HeicToJpgConverter') as mock_converter:
+                with pytest.raises(SystemExit) as exc_info:
+                    main()
+        
+        assert exc_info.value.code == 2
+        assert argv[0] in capsys.readouterr().err
+        mock_converter.assert_not_called()
+
+
+class TestInitWorker:
+    
+    def test_worker_ignores_interrupt(self):
+        """Test conversion processes leave Ctrl-C to the main process"""
+        with patch('heic2jpg.signal.signal') as mock_signal:
+            init_worker()
+        
+        mock_signal.assert_called_once_with(signal.SIGINT, signal.SIG_IGN)
+
+class TestRateLimiter:
+    
+    @patch('heic2jpg.time')
+    def test_burst_within_rate(self, mock_time):
+        """Test calls up to the rate pass without waiting"""
+        mock_time.monotonic.return_value = 0.0
+        limiter = RateLimiter(2)
+        
+        limiter.acquire()
+        limiter.acquire()
+        
+        mock_time.sleep.assert_not_called()
+    
+    @patch('heic2jpg.time')
+    def test_waits_when_exhausted(self, mock_time):
+        """Test calls beyond the burst wait for a token"""
+        mock_time.monotonic.return_value = 0.0
+        limiter = RateLimiter(2)
+        
+        for _ in range(4):
+            limiter.acquire()
+        
+        assert [c.args[0] for c in mock_time.sleep.call_args_list] == [0.5, 1.0]
+    
+    @patch('heic2jpg.time')
+    def test_refills_over_time(self, mock_time):
+        """Test tokens refill as time passes"""
+        mock_time.monotonic.return_value = 0.0
+        limiter = RateLimiter(2)
+        limiter.acquire()
+        limiter.acquire()
+        
+        mock_time.monotonic.return_value = 0.5
+        limiter.acquire()
+        
+        mock_time.sleep.assert_not_called()
+    
+    @patch('heic2jpg.time')
+    def test_zero_rate_disables_limit(self, mock_time):
+        """Test a rate of 0 never waits"""
+        mock_time.monotonic.return_value = 0.0
+        limiter = RateLimiter(0)
+        
+        for _ in range(10):
+            limiter.acquire()
+        
+        mock_time.sleep.assert_not_called()
@@ -4,10 +4,12 @@ Tests for image conversion functionality
 
 import pytest
 from unittest.mock import Mock, patch, MagicMock
-from PIL import Image
+from PIL import Image, JpegImagePlugin
 import io
+from pathlib import Path
+import pillow_heif
 
-from heic2jpg import HeicToJpgConverter
+from heic2jpg import HeicToJpgConverter, choose_quality
 
 class TestImageConversion:
     
@@ -18,6 +20,12 @@ class TestImageConversion:
         image.save(buffer, format='JPEG')
         return buffer.getvalue()
     
+    def create_test_heic(self, size=(100, 100), mode='RGB', color='red'):
+        """Helper to create test HEIC images"""
+        buffer = io.BytesIO()
+        pillow_heif.from_pillow(Image.new(mode, size, color)).save(buffer, quality=90)
+        return buffer.getvalue()
+    
     def test_convert_small_image(self):
         """Test converting small image that doesn't need resizing"""
         converter = HeicToJpgConverter()
@@ -39,7 +47,6 @@ class TestImageConversion:
         assert len(result) > 0
         
         # Verify the image wasn't resized (size is smaller than max)
-        # The thumbnail method should still be called but won't change size
         assert original_image.size == (100, 100)
     
     def test_convert_large_image_resize(self):
@@ -91,9 +98,8 @@ class TestImageConversion:
         for mode in modes_to_test:
             test_image = Image.new(mode, (100, 100), 'red' if mode == 'RGBA' else 128)
             
-            # Mock the convert method
-            rgb_image = Image.new('RGB', (100, 100), 'red')
-            test_image.convert = Mock(return_value=rgb_image)
+            # Spy on the convert method
+            test_image.convert = Mock(wraps=test_image.convert)
             
             with patch('PIL.Image.open') as mock_open:
                 mock_open.return_value = test_image
@@ -103,9 +109,89 @@ class TestImageConversion:
             assert isinstance(result, bytes)
             assert len(result) > 0
             
-            # Verify convert was called for non-RGB modes
-            if mode != 'RGB':
+            # Grayscale is saved as is and RGBA is flattened without convert
+            if mode == 'P':
                 test_image.convert.assert_called_once_with('RGB')
+            else:
+                test_image.convert.assert_not_called()
+            
+            expected_mode = 'L' if mode == 'L' else 'RGB'
+            assert Image.open(io.BytesIO(result)).mode == expected_mode
+    
+    def test_convert_transparent_onto_white(self):
+        """Test transparent pixels come out white instead of their hidden color"""
+        converter = HeicToJpgConverter()
+        
+        for mode, color in [('RGBA', (255, 0, 0, 0)), ('LA', (0, 0))]:
+            with patch('PIL.Image.open') as mock_open:
+                mock_open.return_value = Image.new(mode, (16, 16), color)
+                
+                result = converter.convert_heic_to_jpg(b'mock_heic_data')
+            
+            assert Image.open(io.BytesIO(result)).getpixel((8, 8)) == (255, 255, 255)
+    
+    def test_convert_blends_partial_transparency(self):
+        """Test semi-transparent pixels are blended with the white background"""
+        converter = HeicToJpgConverter()
+        
+        with patch('PIL.Image.open') as mock_open:
+            mock_open.return_value = Image.new('RGBA', (16, 16), (255, 0, 0, 128))
+            
+            result = converter.convert_heic_to_jpg(b'mock_heic_data')
+        
+        pixel = Image.open(io.BytesIO(result)).getpixel((8, 8))
+        assert all(abs(actual - expected) <= 3 for actual, expected in zip(pixel, (255, 127, 127)))
+    
+    def test_convert_within_resize_tolerance(self):
+        """Test images barely over max_size are not resized"""
+        converter = HeicToJpgConverter()
+        
+        for size, expected in [((1930, 1080), (1930, 1080)), ((2000, 1080), (1920, 1037))]:
+            with patch('PIL.Image.open') as mock_open:
+                mock_open.return_value = Image.new('RGB', size, 'blue')
+                
+                result = converter.convert_heic_to_jpg(b'mock_heic_data', max_size=(1920, 1080))
+            
+            assert Image.open(io.BytesIO(result)).size == expected
+    
+    def test_convert_mode_after_resize(self):
+        """Test that color conversion runs on the resized image"""
+        converter = HeicToJpgConverter()
+        
+        large_image = Image.new('CMYK', (3000, 2000), (0, 255, 255, 0))
+        original_convert = Image.Image.convert
+        converted_sizes = []
+        
+        def tracking_convert(image, mode=None, *args, **kwargs):
+            if mode == 'RGB':
+                converted_sizes.append(image.size)
+            return original_convert(image, mode, *args, **kwargs)
+        
+        with patch.object(Image.Image, 'convert', autospec=True, side_effect=tracking_convert):
+            with patch('PIL.Image.open') as mock_open:
+                mock_open.return_value = large_image
+                
+                result = converter.convert_heic_to_jpg(b'mock_heic_data', max_size=(1920, 1080))
+        
+        assert converted_sizes == [(1620, 1080)]
+        assert Image.open(io.BytesIO(result)).size == (1620, 1080)
+    
+    def test_convert_resizes_16bit_grayscale(self):
+        """Test 16-bit grayscale, which LANCZOS cannot resize, is converted before resizing"""
+        converter = HeicToJpgConverter()
+        
+        # Some Pillow versions open 16-bit PNGs as I;16
+        large_image = Image.new('I;16', (800, 600))
+        large_image.putdata([100] * (800 * 600))
+        
+        with patch('PIL.Image.open') as mock_open:
+            mock_open.return_value = large_image
+            
+            result = converter.convert_heic_to_jpg(b'mock_heic_data', max_size=(400, 300))
+        
+        result_image = Image.open(io.BytesIO(result))
+        assert result_image.size == (400, 300)
+        assert result_image.mode == 'L'
     
     def test_convert_various_sizes(self):
         """Test conversion with various max_size constraints"""
@@ -144,8 +230,8 @@ class TestImageConversion:
         with patch('PIL.Image.open') as mock_open:
             mock_open.return_value = original_image
             
-            # Mock thumbnail to verify it's called with correct parameters
-            original_image.thumbnail = Mock()
+            # Mock resize to verify it's called with correct parameters
+            original_image.resize = Mock(return_value=Image.new('RGB', (1920, 960), 'orange'))
             
             converter.convert_heic_to_jpg(
                 b'mock_heic_data',
@@ -153,12 +239,60 @@ class TestImageConversion:
                 max_size=(1920, 1080)
             )
             
-            # Verify thumbnail was called with max_size
-            original_image.thumbnail.assert_called_once_with(
-                (1920, 1080), 
-                Image.Resampling.LANCZOS
+            # Verify resize kept the 2:1 aspect ratio within max_size
+            original_image.resize.assert_called_once_with(
+                (1920, 960), 
+                Image.Resampling.LANCZOS,
+                reducing_gap=3.0
             )
     
+    def test_convert_reduces_before_resize(self):
+        """Test large downscales are box-reduced before the LANCZOS resize"""
+        converter = HeicToJpgConverter()
+        
+        original_image = Image.new('RGB', (4000, 3000), 'purple')
+        
+        with patch('PIL.Image.open') as mock_open:
+            mock_open.return_value = original_image
+            
+            with patch.object(Image.Image, 'reduce', autospec=True,
+                              side_effect=Image.Image.reduce) as mock_reduce:
+                result = converter.convert_heic_to_jpg(b'mock_heic_data', quality=85, max_size=(640, 480))
+        
+        # A 6.25x downscale is box-reduced 2x, leaving a 3.1x LANCZOS step
+        assert mock_reduce.call_count == 1
+        assert mock_reduce.call_args[0][:2] == (original_image, (2, 2))
+        width, height = Image.open(io.BytesIO(result)).size
+        assert abs(width - 640) <= 1
+        assert abs(height - 480) <= 1
+    
+    def test_convert_heic_decoded_directly(self):
+        """Test HEIC data is decoded by libheif without Image.open"""
+        converter = HeicToJpgConverter()
+        
+        for mode in ['RGB', 'RGBA']:
+            heic_data = self.create_test_heic((320, 240), mode)
+            
+            with patch('PIL.Image.open', wraps=Image.open) as mock_open:
+                result = converter.convert_heic_to_jpg(heic_data, max_size=(160, 160))
+            
+            mock_open.assert_not_called()
+            assert Image.open(io.BytesIO(result)).size == (160, 120)
+    
+    def test_convert_jpeg_source_uses_draft(self):
+        """Test JPEG sources are scaled down while decoding"""
+        converter = HeicToJpgConverter()
+        
+        source = io.BytesIO()
+        Image.new('RGB', (4000, 2000), 'orange').save(source, format='JPEG')
+        
+        with patch.object(JpegImagePlugin.JpegImageFile, 'draft', autospec=True,
+                          side_effect=JpegImagePlugin.JpegImageFile.draft) as mock_draft:
+            result = converter.convert_heic_to_jpg(source.getvalue(), quality=85, max_size=(1920, 1080))
+        
+        assert mock_draft.call_args_list[0][0][1:] == ('RGB', (1920, 1080))
+        assert Image.open(io.BytesIO(result)).size == (1920, 960)
+    
     def test_convert_edge_cases(self):
         """Test edge cases in image conversion"""
         converter = HeicToJpgConverter()
@@ -185,6 +319,82 @@ class TestImageConversion:
         assert isinstance(result, bytes)
         assert len(result) > 0
     
+    def test_convert_progressive_output(self):
+        """Test that the output is a progressive JPEG"""
+        converter = HeicToJpgConverter()
+        
+        with patch('PIL.Image.open') as mock_open:
+            mock_open.return_value = Image.new('RGB', (100, 100), 'teal')
+            
+            result = converter.convert_heic_to_jpg(b'mock_heic_data')
+        
+        assert Image.open(io.BytesIO(result)).info.get('progressive')
+    
+    def test_convert_reuses_encode_buffer(self):
+        """Test a smaller JPG after a larger one carries no stale bytes"""
+        converter = HeicToJpgConverter()
+        
+        large = converter.convert_heic_to_jpg(self.create_test_image((800, 600)), quality=95)
+        small = converter.convert_heic_to_jpg(self.create_test_image((50, 50)), quality=50)
+        
+        assert len(small) < len(large)
+        assert small.endswith(b'\xff\xd9')
+        assert Image.open(io.BytesIO(small)).size == (50, 50)
+    
+    def test_convert_chroma_subsampling(self):
+        """Test JPGs use 4:2:0 chroma subsampling even at high quality"""
+        converter = HeicToJpgConverter()
+        
+        result = converter.convert_heic_to_jpg(self.create_test_image(), quality=98)
+        
+        assert JpegImagePlugin.get_sampling(Image.open(io.BytesIO(result))) == 2
+    
+    def test_convert_to_output_path(self, temp_dir):
+        """Test writing the JPG directly to a file path"""
+        converter = HeicToJpgConverter()
+        output_path = Path(temp_dir) / 'out.jpg'
+        
+        with patch('PIL.Image.open') as mock_open:
+            mock_open.return_value = Image.new('RGB', (100, 100), 'navy')
+            
+            result = converter.convert_heic_to_jpg(b'mock_heic_data', output=output_path)
+        
+        assert result is None
+        with Image.open(output_path) as image:
+            assert image.format == 'JPEG'
+    
+    def test_choose_quality(self):
+        """Test quality follows the amount of detail in the image"""
+        flat_image = Image.new('RGB', (100, 100), 'gray')
+        medium_image = Image.effect_noise((100, 100), 30).convert('RGB')
+        detailed_image = Image.effect_noise((100, 100), 80).convert('RGB')
+        
+        assert choose_quality(flat_image, 85) == 78
+        assert choose_quality(medium_image, 85) == 85
+        assert choose_quality(detailed_image, 85) == 88
+        assert choose_quality(detailed_image, 94) == 95
+        assert choose_quality(detailed_image, 98) == 98
+    
+    def test_convert_dynamic_quality(self):
+        """Test dynamic quality lowers the quality used for flat images"""
+        converter = HeicToJpgConverter()
+        
+        original_image = Image.new('RGB', (100, 100), 'gray')
+        saved_qualities = []
+        
+        def mock_save(file_obj, format=None, quality=None, optimize=None, progressive=None, subsampling=None):
+            saved_qualities.append(quality)
+        
+        original_image.save = mock_save
+        
+        with patch('PIL.Image.open') as mock_open:
+            mock_open.return_value = original_image
+            
+            converter.convert_heic_to_jpg(b'mock_heic_data', quality=85, dynamic_quality=True)
+            converter.convert_heic_to_jpg(b'mock_heic_data', quality=85)
+        
+        assert saved_qualities == [78, 85]
+    
     def test_convert_invalid_data(self):
         """Test conversion with invalid HEIC data"""
         converter = HeicToJpgConverter()
@@ -200,9 +410,11 @@ class TestImageConversion:
         original_image = Image.new('RGB', (100, 100), 'yellow')
         
         # Mock the save method to capture arguments
-        def mock_save(file_obj, format=None, quality=None, optimize=None):
-            # Verify optimize flag is set
+        def mock_save(file_obj, format=None, quality=None, optimize=None, progressive=None, subsampling=None):
+            # Verify optimize, progressive and subsampling flags are set
             assert optimize is True
+            assert progressive is True
+            assert subsampling == 2
             assert format == 'JPEG'
             assert quality == 85
             file_obj.write(b'mock_jpg_data')
@@ -2,13 +2,17 @@
 Integration tests for Google Drive API functionality
 """
 
+import asyncio
+import time
 import pytest
 from unittest.mock import Mock, patch, MagicMock
 import tempfile
 import os
+import threading
 from pathlib import Path
+from PIL import Image
 
-from heic2jpg import HeicToJpgConverter
+from heic2jpg import HeicToJpgConverter, Ledger
 
 class TestGoogleDriveIntegration:
     """Integration tests for Google Drive functionality"""
@@ -47,14 +51,11 @@ class TestGoogleDriveIntegration:
                             mock_flow_instance.run_local_server.assert_called_once()
     
     @pytest.mark.integration
-    def test_list_files_with_pagination(self):
+    def test_list_files_with_pagination(self, fake_drive_service):
         """Test listing files with pagination (mocked)"""
         converter = HeicToJpgConverter()
         
-        # Mock service with paginated response
-        mock_service = Mock()
-        
-        # First call returns nextPageToken
+        # First page returns nextPageToken
         first_response = {
             'files': [
                 {'id': 'file1', 'name': 'photo1.heic', 'size': '1024', 'createdTime': '2023-01-01T00:00:00.000Z'}
@@ -69,14 +70,15 @@ class TestGoogleDriveIntegration:
             ]
         }
         
-        mock_service.files().list().execute.side_effect = [first_response, second_response]
-        converter.service = mock_service
+        converter.service = fake_drive_service([first_response, second_response])
         
         files = converter.list_heic_files()
         
-        # Should return files from first call only (our implementation doesn't handle pagination yet)
-        assert len(files) == 1
+        # Should follow nextPageToken and return files from both pages
+        assert len(files) == 2
         assert files[0]['name'] == 'photo1.heic'
+        assert files[1]['name'] == 'photo2.heic'
+        assert len(converter.service.files_resource.list_calls) == 1
     
     @pytest.mark.integration
     def test_download_large_file_chunks(self):
@@ -104,43 +106,38 @@ class TestGoogleDriveIntegration:
                 (mock_status_3, True)
             ]
             
-            mock_download.return_value = mock_downloader
-            
             # Mock file data
             test_data = b'large_file_data_chunk_by_chunk'
-            with patch('io.BytesIO') as mock_bytesio:
-                mock_file_io = Mock()
-                mock_file_io.getvalue.return_value = test_data
-                mock_bytesio.return_value = mock_file_io
-                
-                result = converter.download_file('large_file_id', 'large_file.heic')
             
-            assert result == test_data
+            def create_downloader(fh, request):
+                fh.write(test_data)
+                return mock_downloader
+            
+            mock_download.side_effect = create_downloader
+            
+            with converter.download_file('large_file_id', 'large_file.heic') as result:
+                assert result.read() == test_data
             assert mock_downloader.next_chunk.call_count == 3
     
     @pytest.mark.integration
-    def test_process_files_end_to_end(self, temp_dir):
+    def test_process_files_end_to_end(self, temp_dir, write_mock_jpg, fake_drive_service):
         """Test complete file processing workflow"""
         converter = HeicToJpgConverter()
         
-        # Mock authenticated service
-        mock_service = Mock()
-        converter.service = mock_service
-        
         # Mock file list response
         mock_files = [
             {'id': 'file1', 'name': 'photo1.heic', 'size': '1024000', 'createdTime': '2023-01-01T00:00:00.000Z'},
             {'id': 'file2', 'name': 'photo2.HEIC', 'size': '2048000', 'createdTime': '2023-01-02T00:00:00.000Z'}
         ]
-        mock_service.files().list().execute.return_value = {'files': mock_files}
+        converter.service = fake_drive_service([{'files': mock_files}])
         
         # Mock download
         with patch.object(converter, 'download_file') as mock_download:
-            mock_download.return_value = b'mock_heic_data'
+            mock_download.side_effect = lambda file_id, file_name, fh: fh.write(b'mock_heic_data')
             
             # Mock conversion
             with patch.object(converter, 'convert_heic_to_jpg') as mock_convert:
-                mock_convert.return_value = b'mock_jpg_data'
+                mock_convert.side_effect = write_mock_jpg
                 
                 # Run process_files
                 converter.process_files(output_dir=temp_dir)
@@ -157,34 +154,30 @@ class TestGoogleDriveIntegration:
                 assert output_path_2.exists()
     
     @pytest.mark.integration
-    def test_error_handling_during_processing(self, temp_dir):
+    def test_error_handling_during_processing(self, temp_dir, write_mock_jpg, fake_drive_service):
         """Test error handling during file processing"""
         converter = HeicToJpgConverter()
         
-        # Mock authenticated service
-        mock_service = Mock()
-        converter.service = mock_service
-        
         # Mock file list with multiple files
         mock_files = [
             {'id': 'file1', 'name': 'good_photo.heic', 'size': '1024000', 'createdTime': '2023-01-01T00:00:00.000Z'},
             {'id': 'file2', 'name': 'bad_photo.heic', 'size': '2048000', 'createdTime': '2023-01-02T00:00:00.000Z'},
             {'id': 'file3', 'name': 'another_good.heic', 'size': '1536000', 'createdTime': '2023-01-03T00:00:00.000Z'}
         ]
-        mock_service.files().list().execute.return_value = {'files': mock_files}
+        converter.service = fake_drive_service([{'files': mock_files}])
         
         # Mock download - second file fails
-        def mock_download_side_effect(file_id, file_name):
+        def mock_download_side_effect(file_id, file_name, fh):
             if file_id == 'file2':
                 raise Exception("Download failed")
-            return b'mock_heic_data'
+            fh.write(b'mock_heic_data')
         
         with patch.object(converter, 'download_file') as mock_download:
             mock_download.side_effect = mock_download_side_effect
             
             # Mock conversion
             with patch.object(converter, 'convert_heic_to_jpg') as mock_convert:
-                mock_convert.return_value = b'mock_jpg_data'
+                mock_convert.side_effect = write_mock_jpg
                 
                 # Run process_files - should handle error gracefully
                 converter.process_files(output_dir=temp_dir)
@@ -203,7 +196,7 @@ class TestGoogleDriveIntegration:
                 assert good_file_2.exists()
     
     @pytest.mark.integration
-    def test_skip_existing_files(self, temp_dir):
+    def test_skip_existing_files(self, temp_dir, write_mock_jpg, fake_drive_service):
         """Test skipping files that already exist"""
         converter = HeicToJpgConverter()
         
@@ -211,22 +204,18 @@ class TestGoogleDriveIntegration:
         existing_file = Path(temp_dir) / 'existing.jpg'
         existing_file.write_bytes(b'existing_content')
         
-        # Mock authenticated service
-        mock_service = Mock()
-        converter.service = mock_service
-        
         # Mock file list
         mock_files = [
             {'id': 'file1', 'name': 'existing.heic', 'size': '1024000', 'createdTime': '2023-01-01T00:00:00.000Z'},
             {'id': 'file2', 'name': 'new_file.heic', 'size': '2048000', 'createdTime': '2023-01-02T00:00:00.000Z'}
         ]
-        mock_service.files().list().execute.return_value = {'files': mock_files}
+        converter.service = fake_drive_service([{'files': mock_files}])
         
         with patch.object(converter, 'download_file') as mock_download:
-            mock_download.return_value = b'mock_heic_data'
+            mock_download.side_effect = lambda file_id, file_name, fh: fh.write(b'mock_heic_data')
             
             with patch.object(converter, 'convert_heic_to_jpg') as mock_convert:
-                mock_convert.return_value = b'mock_jpg_data'
+                mock_convert.side_effect = write_mock_jpg
                 
                 converter.process_files(output_dir=temp_dir)
                 
@@ -238,22 +227,332 @@ class TestGoogleDriveIntegration:
                 assert existing_file.read_bytes() == b'existing_content'
     
     @pytest.mark.integration
-    def test_folder_specific_processing(self):
+    def test_skip_existing_files_ignoring_case(self, temp_dir, write_mock_jpg, fake_drive_service):
+        """Test outputs that differ only in case are skipped, as on macOS and Windows they are the same file"""
+        converter = HeicToJpgConverter()
+        
+        existing_file = Path(temp_dir) / 'X.JPG'
+        existing_file.write_bytes(b'existing_content')
+        
+        mock_files = [
+            {'id': 'file1', 'name': 'X.heic'},
+            {'id': 'file2', 'name': 'photo.heic'},
+            {'id': 'file3', 'name': 'PHOTO.HEIC'},
+        ]
+        converter.service = fake_drive_service([{'files': mock_files}])
+        
+        with patch.object(converter, 'download_file') as mock_download:
+            mock_download.side_effect = lambda file_id, file_name, fh: fh.write(b'mock_heic_data')
+            
+            with patch.object(converter, 'convert_heic_to_jpg', side_effect=write_mock_jpg) as mock_convert:
+                with patch.object(converter, 'confirm_deletion', return_value=False):
+                    converter.process_files(output_dir=temp_dir, max_concurrent=1)
+        
+        # Only the first of photo.heic and PHOTO.HEIC is converted
+        assert mock_convert.call_count == 1
+        assert existing_file.read_bytes() == b'existing_content'
+        assert not (Path(temp_dir) / 'X.jpg').exists()
+    
+    @pytest.mark.integration
+    def test_folder_specific_processing(self, temp_dir, fake_drive_service):
         """Test processing files from specific folder"""
         converter = HeicToJpgConverter()
         
+        folder_id = 'specific_folder_123'
+        
+        # Should include folder ID in query
+        converter.service = fake_drive_service([{'files': []}])
+        
+        converter.process_files(output_dir=temp_dir, folder_id=folder_id)
+        
+        # Verify folder ID was used in query
+        query = converter.service.files_resource.list_calls[-1]['q']
+        assert folder_id in query
+        
+        # Nothing was found, so no ledger is left in the output directory
+        assert not (Path(temp_dir) / '.heic2jpg.db').exists()
+    
+    @pytest.mark.integration
+    def test_concurrent_downloads(self, temp_dir, write_mock_jpg, fake_drive_service):
+        """Test that downloads run in parallel up to max_concurrent"""
+        converter = HeicToJpgConverter()
+        
+        mock_files = [
+            {'id': 'file1', 'name': 'photo1.heic', 'size': '1024000', 'createdTime': '2023-01-01T00:00:00.000Z'},
+            {'id': 'file2', 'name': 'photo2.heic', 'size': '2048000', 'createdTime': '2023-01-02T00:00:00.000Z'}
+        ]
+        converter.service = fake_drive_service([{'files': mock_files}])
+        
+        # Both downloads must be in flight at once to get past the barrier
+        barrier = threading.Barrier(2, timeout=5)
+        
+        def mock_download_side_effect(file_id, file_name, fh):
+            barrier.wait()
+            fh.write(b'mock_heic_data')
+        
+        with patch.object(converter, 'download_file') as mock_download:
+            mock_download.side_effect = mock_download_side_effect
+            
+            with patch.object(converter, 'convert_heic_to_jpg') as mock_convert:
+                mock_convert.side_effect = write_mock_jpg
+                
+                with patch.object(converter, 'confirm_deletion', return_value=False):
+                    converter.process_files(output_dir=temp_dir, max_concurrent=2)
+                
+                assert mock_convert.call_count == 2
+                assert (Path(temp_dir) / 'photo1.jpg').exists()
+                assert (Path(temp_dir) / 'photo2.jpg').exists()
+    
+    @pytest.mark.integration
+    def test_downloads_continue_while_converting(self, temp_dir, write_mock_jpg, fake_drive_service):
+        """Test that downloading does not wait for busy conversions"""
+        converter = HeicToJpgConverter()
+        
+        mock_files = [
+            {'id': f'file{i}', 'name': f'photo{i}.heic', 'size': '1024', 'createdTime': '2023-01-01T00:00:00.000Z'}
+            for i in range(5)
+        ]
+        converter.service = fake_drive_service([{'files': mock_files}])
+        
+        # Conversions block until every file has been downloaded
+        downloaded = []
+        all_downloaded = threading.Event()
+        
+        def mock_download_side_effect(file_id, file_name, fh):
+            fh.write(b'mock_heic_data')
+            downloaded.append(file_id)
+            if len(downloaded) == len(mock_files):
+                all_downloaded.set()
+        
+        def mock_convert_side_effect(heic_data, quality, max_size, output, dynamic_quality):
+            assert all_downloaded.wait(timeout=5)
+            write_mock_jpg(heic_data, quality, max_size, output)
+        
+        with patch.object(converter, 'download_file') as mock_download:
+            mock_download.side_effect = mock_download_side_effect
+            
+            with patch.object(converter, 'convert_heic_to_jpg') as mock_convert:
+                mock_convert.side_effect = mock_convert_side_effect
+                
+                with patch.object(converter, 'confirm_deletion', return_value=False):
+                    converter.process_files(output_dir=temp_dir, max_concurrent=2)
+                
+                assert mock_convert.call_count == 5
+                assert len(list(Path(temp_dir).glob('*.jpg'))) == 5
+    
+    @pytest.mark.integration
+    def test_listing_overlaps_processing(self, temp_dir, write_mock_jpg):
+        """Test that later pages are listed while earlier files are processed"""
+        converter = HeicToJpgConverter()
+        
         # Mock authenticated service
         mock_service = Mock()
         converter.service = mock_service
         
-        folder_id = 'specific_folder_123'
+        first_download_started = threading.Event()
+        list_calls = []
         
-        # Should include folder ID in query
-        mock_service.files().list().execute.return_value = {'files': []}
+        def mock_list_side_effect(**kwargs):
+            list_calls.append(1)
+            if len(list_calls) == 1:
+                return {
+                    'files': [{'id': 'file1', 'name': 'photo1.heic'}],
+                    'nextPageToken': 'next_token_123'
+                }
+            # Second page is only released once the first file is downloading
+            assert first_download_started.wait(timeout=5)
+            return {'files': [{'id': 'file2', 'name': 'photo2.heic'}]}
         
-        converter.process_files(folder_id=folder_id)
+        mock_service.files().list().execute.side_effect = mock_list_side_effect
+        mock_service.files().list_next.side_effect = [mock_service.files().list(), None]
         
-        # Verify folder ID was used in query
-        call_args = mock_service.files().list.call_args
-        query = call_args[1]['q']
-        assert folder_id in query
\ No newline at end of file
+        def mock_download_side_effect(file_id, file_name, fh):
+            first_download_started.set()
+            fh.write(b'mock_heic_data')
+        
+        with patch.object(converter, 'download_file') as mock_download:
+            mock_download.side_effect = mock_download_side_effect
+            
+            with patch.object(converter, 'convert_heic_to_jpg') as mock_convert:
+                mock_convert.side_effect = write_mock_jpg
+                
+                with patch.object(converter, 'confirm_deletion', return_value=False):
+                    converter.process_files(output_dir=temp_dir)
+                
+                assert mock_download.call_count == 2
+                assert (Path(temp_dir) / 'photo2.jpg').exists()
+    
+    @pytest.mark.integration
+    @pytest.mark.slow
+    def test_process_files_with_worker_processes(self, temp_dir, sample_image_data, fake_drive_service):
+        """Test conversion in worker processes produces the JPG files"""
+        converter = HeicToJpgConverter()
+        
+        mock_files = [
+            {'id': 'file1', 'name': 'photo1.heic', 'size': '1024000', 'createdTime': '2023-01-01T00:00:00.000Z'},
+            {'id': 'file2', 'name': 'photo2.heic', 'size': '2048000', 'createdTime': '2023-01-02T00:00:00.000Z'}
+        ]
+        converter.service = fake_drive_service([{'files': mock_files}])
+        
+        # Real image data, since the conversion itself runs in the workers
+        with patch.object(converter, 'download_file') as mock_download:
+            mock_download.side_effect = lambda file_id, file_name, fh: fh.write(sample_image_data)
+            
+            with patch.object(converter, 'confirm_deletion', return_value=False):
+                converter.process_files(output_dir=temp_dir, processes=2)
+        
+        for name in ('photo1.jpg', 'photo2.jpg'):
+            with Image.open(Path(temp_dir) / name) as image:
+                assert image.format == 'JPEG'
+    
+    @pytest.mark.integration
+    def test_worker_processes_not_started_without_new_files(self, temp_dir, fake_drive_service):
+        """Test runs with nothing to convert spawn no worker processes"""
+        converter = HeicToJpgConverter()
+        
+        (Path(temp_dir) / 'photo1.jpg').write_bytes(b'existing_content')
+        converter.service = fake_drive_service([{'files': [{'id': 'file1', 'name': 'photo1.heic'}]}])
+        
+        with patch('heic2jpg.ProcessPoolExecutor') as mock_pool:
+            with patch.object(converter, 'download_file') as mock_download:
+                converter.process_files(output_dir=temp_dir, processes=2)
+        
+        mock_download.assert_not_called()
+        mock_pool.assert_not_called()
+    
+    @pytest.mark.integration
+    def test_auto_delete_in_batches_during_processing(self, temp_dir, write_mock_jpg, fake_drive_service):
+        """Test auto-delete sends full batches while files are still converting"""
+        converter = HeicToJpgConverter()
+        
+        mock_files = [{'id': f'file{i}', 'name': f'photo{i}.heic'} for i in range(150)]
+        converter.service = fake_drive_service([{'files': mock_files}])
+        
+        with patch.object(converter, 'download_file') as mock_download:
+            mock_download.side_effect = lambda file_id, file_name, fh: fh.write(b'mock_heic_data')
+            
+            with patch.object(converter, 'convert_heic_to_jpg', side_effect=write_mock_jpg):
+                with patch.object(converter, 'delete_drive_files') as mock_delete:
+                    mock_delete.side_effect = len
+                    
+                    with patch.object(converter, 'confirm_deletion') as mock_confirm:
+                        converter.process_files(output_dir=temp_dir, auto_delete=True)
+        
+        mock_confirm.assert_not_called()
+        batch_sizes = [len(c.args[0]) for c in mock_delete.call_args_list]
+        assert batch_sizes == [100, 50]
+    
+    @pytest.mark.integration
+    def test_resume_skips_files_in_ledger(self, temp_dir, write_mock_jpg, fake_drive_service):
+        """Test files recorded in the ledger are not downloaded again"""
+        converter = HeicToJpgConverter()
+        
+        mock_files = [
+            {'id': 'file1', 'name': 'photo1.heic', 'size': '1024000', 'createdTime': '2023-01-01T00:00:00.000Z'},
+            {'id': 'file2', 'name': 'photo2.heic', 'size': '2048000', 'createdTime': '2023-01-02T00:00:00.000Z'}
+        ]
+        converter.service = fake_drive_service([{'files': mock_files}])
+        
+        with patch.object(converter, 'download_file') as mock_download:
+            mock_download.side_effect = lambda file_id, file_name, fh: fh.write(b'mock_heic_data')
+            
+            with patch.object(converter, 'convert_heic_to_jpg', side_effect=write_mock_jpg):
+                with patch.object(converter, 'confirm_deletion', return_value=False):
+                    converter.process_files(output_dir=temp_dir)
+                    
+                    # Converted files moved elsewhere (e.g. into a blog) are still done
+                    (Path(temp_dir) / 'photo1.jpg').unlink()
+                    converter.process_files(output_dir=temp_dir)
+        
+        assert mock_download.call_count == 2
+        assert (Path(temp_dir) / '.heic2jpg.db').exists()
+    
+    @pytest.mark.integration
+    def test_ledger_written_off_event_loop(self, temp_dir, write_mock_jpg, fake_drive_service):
+        """Test ledger commits run on pool threads rather than the event loop thread"""
+        converter = HeicToJpgConverter()
+        
+        mock_files = [{'id': f'file{i}', 'name': f'photo{i}.heic'} for i in range(3)]
+        converter.service = fake_drive_service([{'files': mock_files}])
+        
+        add_threads = []
+        original_add = Ledger.add
+        
+        def recording_add(ledger, file_id, output):
+            add_threads.append(threading.current_thread())
+            original_add(ledger, file_id, output)
+        
+        with patch.object(converter, 'download_file') as mock_download:
+            mock_download.side_effect = lambda file_id, file_name, fh: fh.write(b'mock_heic_data')
+            
+            with patch.object(converter, 'convert_heic_to_jpg', side_effect=write_mock_jpg):
+                with patch.object(Ledger, 'add', autospec=True, side_effect=recording_add):
+                    with patch.object(converter, 'confirm_deletion', return_value=False):
+                        converter.process_files(output_dir=temp_dir)
+                
+                    # Recorded, so a second run downloads nothing
+                    converter.process_files(output_dir=temp_dir)
+        
+        assert len(add_threads) == 3
+        assert threading.main_thread() not in add_threads
+        assert mock_download.call_count == 3
+    
+    @pytest.mark.integration
+    def test_failed_conversion_leaves_no_partial_file(self, temp_dir, fake_drive_service):
+        """Test a conversion that fails mid-write leaves no output behind"""
+        converter = HeicToJpgConverter()
+        
+        converter.service = fake_drive_service([{'files': [{'id': 'file1', 'name': 'photo1.heic'}]}])
+        
+        def failing_convert(heic_data, quality, max_size, output, dynamic_quality):
+            Path(output).write_bytes(b'truncated')
+            raise OSError("Disk full")
+        
+        with patch.object(converter, 'download_file') as mock_download:
+            mock_download.side_effect = lambda file_id, file_name, fh: fh.write(b'mock_heic_data')
+            
+            with patch.object(converter, 'convert_heic_to_jpg', side_effect=failing_convert):
+                converter.process_files(output_dir=temp_dir)
+        
+        assert not (Path(temp_dir) / 'photo1.jpg').exists()
+        assert not (Path(temp_dir) / 'photo1.jpg.part').exists()
+    
+    @pytest.mark.integration
+    def test_cancel_during_deletion_prompt(self, temp_dir, write_mock_jpg, fake_drive_service):
+        """Test a run cancelled at the deletion prompt stops without waiting for an answer"""
+        converter = HeicToJpgConverter()
+        
+        converter.service = fake_drive_service([{'files': [{'id': 'file1', 'name': 'photo1.heic'}]}])
+        
+        prompted = threading.Event()
+        answered = threading.Event()
+        
+        def confirm_deletion(file_count):
+            # Stands in for input() waiting on a user who never answers
+            prompted.set()
+            answered.wait(10)
+            return False
+        
+        async def run_and_cancel():
+            task = asyncio.create_task(converter._process_files_async(
+                temp_dir, 85, (1920, 1080), None, False, 2
+            ))
+            while not prompted.is_set():
+                await asyncio.sleep(0.01)
+            task.cancel()
+            started = time.monotonic()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+            return time.monotonic() - started
+        
+        with patch.object(converter, 'download_file') as mock_download:
+            mock_download.side_effect = lambda file_id, file_name, fh: fh.write(b'mock_heic_data')
+            
+            with patch.object(converter, 'convert_heic_to_jpg', side_effect=write_mock_jpg):
+                with patch.object(converter, 'confirm_deletion', side_effect=confirm_deletion):
+                    try:
+                        elapsed = asyncio.run(run_and_cancel())
+                    finally:
+                        answered.set()
+        
+        assert elapsed < 1